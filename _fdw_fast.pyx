@@ -0,0 +1,83 @@
+# cython: language_level=3
+"""
+Compiled row validation and conversion for the OpenAI FDW
+
+Both functions take a column spec: a tuple of (column_name, kind) pairs
+built by OpenAIForeignDataWrapper, where kind is one of the KIND_*
+constants defined in openai_fdw.
+"""
+
+cdef enum:
+    KIND_INTEGER = 0
+    KIND_FLOAT = 1
+    KIND_BOOLEAN = 2
+    KIND_TEXT = 3
+    KIND_OTHER = 4
+
+
+cpdef bint validate_row(object row_data, tuple spec):
+    """
+    Validate that a row from the API response matches the column spec
+
+    Values must have exactly the column's type; nulls and missing columns
+    are accepted and become NULL.
+    """
+    cdef int kind
+    
+    if not isinstance(row_data, dict):
+        return False
+    
+    for column_name, kind in spec:
+        value = row_data.get(column_name)
+        if value is None:
+            continue
+        
+        if kind == KIND_INTEGER:
+            if type(value) is not int:
+                return False
+        elif kind == KIND_FLOAT:
+            if type(value) is not float and type(value) is not int:
+                return False
+        elif kind == KIND_BOOLEAN:
+            if type(value) is not bool:
+                return False
+        elif kind == KIND_TEXT:
+            if type(value) is not str:
+                return False
+    
+    return True
+
+
+cpdef dict convert_row(dict row_data, tuple spec):
+    """
+    Convert a row from the API response to PostgreSQL format, raising
+    TypeError or ValueError for values a column cannot represent faithfully
+    """
+    cdef dict converted_row = {}
+    cdef int kind
+    
+    for column_name, kind in spec:
+        value = row_data.get(column_name)
+        
+        if value is None:
+            converted_row[column_name] = None
+        elif kind == KIND_INTEGER:
+            if type(value) is bool:
+                raise TypeError(f'{value!r} is not a number')
+            if type(value) is float and not value.is_integer():
+                raise ValueError(f'{value!r} is not a whole number')
+            converted_row[column_name] = int(value)
+        elif kind == KIND_FLOAT:
+            if type(value) is bool:
+                raise TypeError(f'{value!r} is not a number')
+            converted_row[column_name] = float(value)
+        elif kind == KIND_BOOLEAN:
+            if type(value) is not bool:
+                raise TypeError(f'{value!r} is not a boolean')
+            converted_row[column_name] = value
+        else:
+            if type(value) is dict or type(value) is list or type(value) is bool:
+                raise TypeError(f'{value!r} is not a scalar value')
+            converted_row[column_name] = str(value)
+    
+    return converted_row
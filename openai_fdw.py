@@ -5,12 +5,270 @@ This FDW allows PostgreSQL to create tables based on OpenAI API responses
 with schema validation to ensure JSON data matches table structure.
 """
 
-import json
+import itertools
+import math
+import orjson
 import requests
+import time
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from multicorn import ForeignDataWrapper
 from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
 from logging import INFO
 
+try:
+    from _fdw_fast import convert_row, validate_row
+except ImportError:
+    # The compiled extension is optional; the pure Python loops are used instead
+    convert_row = validate_row = None
+
+try:
+    import tiktoken
+except ImportError:
+    # Optional; without it prompt sizes are not measured
+    tiktoken = None
+
+
+OPENAI_CHAT_URL = 'https://api.openai.com/v1/chat/completions'
+OPENAI_FILES_URL = 'https://api.openai.com/v1/files'
+OPENAI_BATCHES_URL = 'https://api.openai.com/v1/batches'
+
+# Rough output tokens per generated column value, and the share of max_tokens
+# a request may be planned to use before its rows are split across shards
+ESTIMATED_TOKENS_PER_COLUMN = 25
+OUTPUT_TOKEN_HEADROOM = 0.9
+
+# Upper bound in seconds between polls of a pending batch job
+BATCH_POLL_MAX_INTERVAL = 60
+
+# Responses worth retrying, and the upper bound in seconds between retries
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_MAX_INTERVAL = 30
+
+# Connections kept alive to the API, and the most shard requests in flight
+HTTP_POOL_SIZE = 16
+
+# Shared by every wrapper instance and shard thread so that connections to
+# the API are kept alive and reused instead of re-handshaking per request
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# Rows from recent API calls, shared by all wrapper instances in the backend:
+# maps a request key to (time.monotonic() when stored, rows), oldest first
+_RESPONSE_CACHE = OrderedDict()
+RESPONSE_CACHE_SIZE = 128
+
+# PostgreSQL type names grouped by how their values are generated and checked
+INTEGER_TYPES = ['integer', 'int4', 'int8', 'bigint', 'smallint']
+FLOAT_TYPES = ['real', 'float4', 'float8', 'double precision', 'numeric', 'decimal']
+BOOLEAN_TYPES = ['boolean', 'bool']
+TEXT_TYPES = ['text', 'varchar', 'char', 'date', 'timestamp', 'timestamptz']
+
+# Column kinds, as used in the (name, kind) column specs passed to _fdw_fast
+KIND_INTEGER, KIND_FLOAT, KIND_BOOLEAN, KIND_TEXT, KIND_OTHER = range(5)
+
+_COLUMN_KINDS = {
+    **dict.fromkeys(INTEGER_TYPES, KIND_INTEGER),
+    **dict.fromkeys(FLOAT_TYPES, KIND_FLOAT),
+    **dict.fromkeys(BOOLEAN_TYPES, KIND_BOOLEAN),
+    **dict.fromkeys(TEXT_TYPES, KIND_TEXT),
+}
+
+# Source of the exact type test that rejects a non-null value of each column
+# kind; other columns are not type checked
+_KIND_CHECK_SOURCE = {
+    KIND_INTEGER: 'type(value) is not int',
+    KIND_FLOAT: 'type(value) is not float and type(value) is not int',
+    KIND_BOOLEAN: 'type(value) is not bool',
+    KIND_TEXT: 'type(value) is not str',
+}
+
+
+def _to_integer(value):
+    """
+    Convert a value for an integer column, rejecting booleans and fractional
+    numbers rather than turning them into 1/0 or truncating them
+    """
+    if type(value) is bool:
+        raise TypeError(f'{value!r} is not a number')
+    if type(value) is float and not value.is_integer():
+        raise ValueError(f'{value!r} is not a whole number')
+    return int(value)
+
+
+def _to_float(value):
+    """
+    Convert a value for a float column, rejecting booleans rather than
+    turning them into 1.0/0.0
+    """
+    if type(value) is bool:
+        raise TypeError(f'{value!r} is not a number')
+    return float(value)
+
+
+def _to_boolean(value):
+    """
+    Accept only JSON booleans for a boolean column, since bool() would turn
+    strings such as "false" into True
+    """
+    if type(value) is not bool:
+        raise TypeError(f'{value!r} is not a boolean')
+    return value
+
+
+def _to_text(value):
+    """
+    Convert a value for a text column, rejecting JSON objects, arrays and
+    booleans rather than storing their Python repr
+    """
+    if type(value) is dict or type(value) is list or type(value) is bool:
+        raise TypeError(f'{value!r} is not a scalar value')
+    return str(value)
+
+
+# Conversion applied to non-null values of each column kind; other columns
+# are passed to PostgreSQL as text. Each raises TypeError or ValueError for
+# values the column cannot represent faithfully.
+_KIND_CONVERTERS = {
+    KIND_INTEGER: _to_integer,
+    KIND_FLOAT: _to_float,
+    KIND_BOOLEAN: _to_boolean,
+    KIND_TEXT: _to_text,
+    KIND_OTHER: _to_text,
+}
+
+# JSON Schema type for each PostgreSQL column type, used for structured
+# outputs; any type not listed is requested as a string
+_JSON_SCHEMA_TYPES = {
+    **dict.fromkeys(INTEGER_TYPES, 'integer'),
+    **dict.fromkeys(FLOAT_TYPES, 'number'),
+    **dict.fromkeys(BOOLEAN_TYPES, 'boolean'),
+}
+
+
+def _iter_json_array(chunks):
+    """
+    Yield the elements of a JSON array as soon as each one is complete in an
+    iterable of text chunks, ignoring any text before the opening bracket
+    (such as the '{"rows": ' wrapper of a JSON mode response)
+
+    Every top-level element is yielded, scalars included, so the caller can
+    reject rows that are not objects. Each character is scanned once,
+    tracking string and bracket depth, and only the text of the element in
+    progress is kept between chunks.
+    """
+    buffer = ''
+    scan = 0
+    element_start = None
+    depth = 0
+    started = False
+    in_string = False
+    escaped = False
+    
+    for chunk in chunks:
+        buffer += chunk
+        
+        for i in range(scan, len(buffer)):
+            c = buffer[i]
+            
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+                    if started and depth == 0:
+                        # End of a top-level string element
+                        yield orjson.loads(buffer[element_start:i + 1])
+                        element_start = None
+            elif not started:
+                if c == '"':
+                    in_string = True
+                else:
+                    started = c == '['
+            elif c == '"':
+                if depth == 0:
+                    element_start = i
+                in_string = True
+            elif c in '{[':
+                if depth == 0:
+                    element_start = i
+                depth += 1
+            elif c in '}]':
+                if depth == 0:
+                    # Closing bracket of the array itself, which also ends
+                    # a pending number or literal
+                    if element_start is not None:
+                        yield orjson.loads(buffer[element_start:i])
+                    return
+                depth -= 1
+                if depth == 0:
+                    yield orjson.loads(buffer[element_start:i + 1])
+                    element_start = None
+            elif depth == 0:
+                # Numbers and true/false/null run until the next separator
+                if c == ',' or c.isspace():
+                    if element_start is not None:
+                        yield orjson.loads(buffer[element_start:i])
+                        element_start = None
+                elif element_start is None:
+                    element_start = i
+        
+        if element_start is None:
+            buffer = ''
+            scan = 0
+        else:
+            buffer = buffer[element_start:]
+            scan = len(buffer)
+            element_start = 0
+    
+    raise ValueError(f'Streamed response ended before the JSON array was complete: {buffer[:200]}')
+
+
+def _compile_row_functions(column_buckets):
+    """
+    Generate validate(row_data) and convert(row_data) functions specialised to
+    columns bucketed by kind, with straight-line code for each column
+    instead of a loop and type dispatch per value
+    """
+    validate_lines = [
+        'def validate(row_data):',
+        '    if not isinstance(row_data, dict):',
+        '        return False',
+        '    get = row_data.get',
+    ]
+    convert_lines = [
+        'def convert(row_data):',
+        '    get = row_data.get',
+    ]
+    converted_items = []
+    
+    for kind, column_names in column_buckets.items():
+        for column_name in column_names:
+            # Column names come from the table definition, so they are only
+            # ever embedded as repr() literals
+            name = repr(column_name)
+            
+            if kind in _KIND_CHECK_SOURCE:
+                validate_lines.append(f'    value = get({name})')
+                validate_lines.append(f'    if value is not None and {_KIND_CHECK_SOURCE[kind]}:')
+                validate_lines.append('        return False')
+            
+            i = len(converted_items)
+            convert_lines.append(f'    v{i} = get({name})')
+            converted_items.append(f'{name}: None if v{i} is None else convert_{kind}(v{i})')
+    
+    validate_lines.append('    return True')
+    convert_lines.append(f'    return {{{", ".join(converted_items)}}}')
+    
+    namespace = {f'convert_{kind}': converter for kind, converter in _KIND_CONVERTERS.items()}
+    source = '\n'.join(validate_lines + [''] + convert_lines) + '\n'
+    exec(compile(source, '<openai_fdw row functions>', 'exec'), namespace)
+    
+    return namespace['validate'], namespace['convert']
+
 
 class OpenAIForeignDataWrapper(ForeignDataWrapper):
     """
@@ -32,13 +290,80 @@ class OpenAIForeignDataWrapper(ForeignDataWrapper):
         
         self.model = options.get('model', 'gpt-3.5-turbo')
         self.max_tokens = int(options.get('max_tokens', '2000'))
+        if self.max_tokens <= 0:
+            log_to_postgres('max_tokens must be greater than 0 for OpenAI FDW', ERROR)
         self.temperature = float(options.get('temperature', '0.7'))
         self.max_rows = int(options.get('max_rows', '100'))
+        # There is never more than one shard per row
+        self.shard_count = max(1, min(int(options.get('shard_count', '1')), self.max_rows))
+        # More threads than pooled connections would open and discard extra
+        # connections instead of reusing them
+        self.max_concurrency = max(1, min(int(options.get('max_concurrency', '8')), HTTP_POOL_SIZE))
+        self.max_attempts = max(1, int(options.get('max_attempts', '3')))
+        self.use_batch_api = options.get('use_batch_api', 'false').lower() == 'true'
+        self.stream = options.get('stream', 'false').lower() == 'true'
+        self.strict_validation = options.get('strict_validation', 'false').lower() == 'true'
+        self.response_format = options.get('response_format', 'json_object').lower()
+        if self.response_format not in ['json_object', 'json_schema']:
+            log_to_postgres(f'Unsupported response_format: {self.response_format}', ERROR)
+        # Sampled output differs between calls, so only cache deterministic
+        # requests unless a TTL is configured explicitly
+        self.cache_ttl = float(options.get('cache_ttl', '300' if self.temperature == 0 else '0'))
+        
+        # Content-Type is set by requests for JSON and multipart bodies
+        self._headers = {'Authorization': f'Bearer {self.api_key}'}
         
         self.columns = columns
         self.column_names = list(columns.keys())
         
-        self._response_cache = None
+        # Column types are resolved once here rather than for every row, and
+        # columns are bucketed by kind so each bucket shares one type test
+        self._column_spec = tuple(
+            (column_name, _COLUMN_KINDS.get(column_def.type_name.lower(), KIND_OTHER))
+            for column_name, column_def in columns.items()
+        )
+        self._column_buckets = {kind: [] for kind in (KIND_INTEGER, KIND_FLOAT, KIND_BOOLEAN, KIND_TEXT, KIND_OTHER)}
+        for column_name, kind in self._column_spec:
+            self._column_buckets[kind].append(column_name)
+        if convert_row is None:
+            # Only needed when the compiled _fdw_fast extension is not built
+            self._validate, self._convert = _compile_row_functions(self._column_buckets)
+        
+        # The schema instruction depends only on the table definition, so it
+        # is built once here rather than on every scan
+        self._schema_instruction = self._generate_schema_info()
+        self._full_prompt_prefix = f"{self.prompt}\n\n{self._schema_instruction}"
+        self._schema_dict = {
+            'type': 'object',
+            'properties': {
+                column_name: {'type': [_JSON_SCHEMA_TYPES.get(column_def.type_name.lower(), 'string'), 'null']}
+                for column_name, column_def in columns.items()
+            },
+            'required': self.column_names,
+            'additionalProperties': False
+        }
+        
+        # Split requests whose rows would not fit in max_tokens up front, since
+        # a truncated response cannot be parsed and returns no rows at all.
+        # Streaming needs a single request and keeps the rows received before
+        # a cut-off, so streamed tables are only warned about instead.
+        # Shards hold at least one row, so a row that alone exceeds the
+        # budget cannot be fixed by sharding either.
+        estimated_row_tokens = ESTIMATED_TOKENS_PER_COLUMN * len(columns)
+        output_token_budget = self.max_tokens * OUTPUT_TOKEN_HEADROOM
+        if estimated_row_tokens > output_token_budget:
+            log_to_postgres(f'Estimated {estimated_row_tokens} output tokens per row exceed max_tokens, responses may be cut off', WARNING)
+        
+        estimated_output_tokens = estimated_row_tokens * self.max_rows
+        required_shards = min(math.ceil(estimated_output_tokens / output_token_budget), max(1, self.max_rows))
+        if required_shards > self.shard_count:
+            if self.stream:
+                log_to_postgres(f'Estimated {estimated_output_tokens} output tokens exceed max_tokens, streamed output may be cut off', WARNING)
+            else:
+                log_to_postgres(f'Estimated {estimated_output_tokens} output tokens exceed max_tokens, using {required_shards} shards', DEBUG)
+                self.shard_count = required_shards
+        
+        self._batch_id = None
         
         log_to_postgres(f'OpenAI FDW initialized with model: {self.model}', DEBUG)
 
@@ -47,19 +372,33 @@ class OpenAIForeignDataWrapper(ForeignDataWrapper):
         Execute the query by calling OpenAI API and returning matching rows
         """
         try:
-            schema_info = self._generate_schema_info()
-            
-            response_data = self._make_openai_request(schema_info)
-            
-            if not response_data:
-                log_to_postgres('No data returned from OpenAI API', WARNING)
-                return
+            if self.stream and self.shard_count == 1 and not self.use_batch_api:
+                response_data = self._stream_openai_request()
+            else:
+                response_data = self._make_openai_request()
+                
+                if not response_data:
+                    log_to_postgres('No data returned from OpenAI API', WARNING)
+                    return
             
             for row_data in response_data:
-                if self._validate_row_schema(row_data):
-                    yield self._convert_row_to_postgres_format(row_data)
-                else:
-                    log_to_postgres(f'Skipping invalid row: {row_data}', WARNING)
+                if self.strict_validation:
+                    if self._validate_row_schema(row_data):
+                        yield self._convert_row_to_postgres_format(row_data)
+                    else:
+                        log_to_postgres(f'Skipping invalid row: {row_data}', WARNING)
+                    continue
+                
+                # Without strict validation the converters reject values the
+                # column cannot represent: fractional integers, booleans
+                # outside boolean columns, other values in boolean columns,
+                # and objects or arrays as text
+                try:
+                    converted_row = self._convert_row_to_postgres_format(row_data)
+                except (AttributeError, TypeError, ValueError) as e:
+                    log_to_postgres(f'Skipping invalid row: {row_data} ({e})', WARNING)
+                    continue
+                yield converted_row
                     
         except Exception as e:
             log_to_postgres(f'Error in OpenAI FDW execution: {str(e)}', ERROR)
@@ -74,11 +413,11 @@ class OpenAIForeignDataWrapper(ForeignDataWrapper):
         for column_name, column_def in self.columns.items():
             pg_type = column_def.type_name.lower()
             
-            if pg_type in ['integer', 'int4', 'int8', 'bigint', 'smallint']:
+            if pg_type in INTEGER_TYPES:
                 json_type = 'number (integer)'
-            elif pg_type in ['real', 'float4', 'float8', 'double precision', 'numeric', 'decimal']:
+            elif pg_type in FLOAT_TYPES:
                 json_type = 'number (float)'
-            elif pg_type in ['boolean', 'bool']:
+            elif pg_type in BOOLEAN_TYPES:
                 json_type = 'boolean'
             elif pg_type in ['date']:
                 json_type = 'string (YYYY-MM-DD format)'
@@ -90,38 +429,189 @@ class OpenAIForeignDataWrapper(ForeignDataWrapper):
             schema_obj[column_name] = json_type
         
         schema_instruction = f"""
-IMPORTANT: Return ONLY a valid JSON array of objects. Each object must match this exact schema:
+IMPORTANT: Return ONLY a valid JSON object with a "rows" key holding an array of objects. Each object must match this exact schema:
 
-{json.dumps(schema_obj, indent=2)}
+{orjson.dumps(schema_obj, option=orjson.OPT_INDENT_2).decode()}
 
 Example format:
-[
+{{"rows": [
   {{{', '.join([f'"{k}": <{v}>' for k, v in schema_obj.items()])}}},
   {{{', '.join([f'"{k}": <{v}>' for k, v in schema_obj.items()])}}}
-]
-
-Return {self.max_rows} rows maximum. Do not include any text before or after the JSON array.
+]}}
 """
         
         return schema_instruction
 
-    def _make_openai_request(self, schema_info):
+    def _make_openai_request(self):
         """
-        Make HTTP request to OpenAI API with schema validation instructions
+        Make HTTP request(s) to OpenAI API with schema validation instructions
+
+        When shard_count is greater than one the requested rows are split across
+        that many chat completions, which are issued concurrently and merged.
+        Results are cached for cache_ttl seconds.
         """
-        full_prompt = f"{self.prompt}\n\n{schema_info}"
+        data = self._get_cached_rows()
+        if data is not None:
+            return data
         
-        headers = {
-            'Authorization': f'Bearer {self.api_key}',
-            'Content-Type': 'application/json'
-        }
+        # Spread max_rows as evenly as possible, without empty shards
+        shards = max(1, min(self.shard_count, self.max_rows))
+        rows_per_shard, extra_rows = divmod(self.max_rows, shards)
+        payloads = [
+            self._build_payload(rows_per_shard + (1 if i < extra_rows else 0), i, shards)
+            for i in range(shards)
+        ]
+        
+        try:
+            log_to_postgres(f'Making {len(payloads)} OpenAI API request(s) with model: {self.model}', DEBUG)
+            
+            if self.use_batch_api:
+                results = self._request_batch_rows(payloads)
+            elif len(payloads) == 1:
+                results = [self._request_rows(payloads[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(len(payloads), self.max_concurrency)) as executor:
+                    results = list(executor.map(self._request_rows, payloads))
+            
+            data = list(itertools.chain.from_iterable(results))
+            
+            log_to_postgres(f'Successfully parsed {len(data)} rows from OpenAI response', INFO)
+            
+            self._cache_rows(data)
+            return data
+                
+        except requests.exceptions.RequestException as e:
+            log_to_postgres(f'HTTP request failed: {str(e)}', ERROR)
+            return None
+        except ValueError as e:
+            log_to_postgres(str(e), ERROR)
+            return None
+        except Exception as e:
+            log_to_postgres(f'Unexpected error in OpenAI request: {str(e)}', ERROR)
+            return None
+
+    def _stream_openai_request(self):
+        """
+        Stream a single chat completion and yield each row as soon as it has
+        been received, instead of waiting for the whole response
+        """
+        data = self._get_cached_rows()
+        if data is not None:
+            yield from data
+            return
+        
+        payload = self._build_payload(self.max_rows)
+        payload['stream'] = True
+        
+        data = []
+        try:
+            log_to_postgres(f'Making streaming OpenAI API request with model: {self.model}', DEBUG)
+            
+            with self._send('POST', OPENAI_CHAT_URL, json=payload, stream=True) as response:
+                for row_data in _iter_json_array(self._iter_stream_content(response)):
+                    data.append(row_data)
+                    yield row_data
+                    
+        except requests.exceptions.RequestException as e:
+            log_to_postgres(f'HTTP request failed: {str(e)}', ERROR)
+            return
+        except ValueError as e:
+            # Rows already yielded are kept; the model output was cut short
+            log_to_postgres(str(e), WARNING)
+            return
+        
+        log_to_postgres(f'Successfully parsed {len(data)} rows from OpenAI response', INFO)
+        self._cache_rows(data)
+
+    def _iter_stream_content(self, response):
+        """
+        Yield the content deltas of a streamed chat completion response
+        """
+        for line in response.iter_lines():
+            if not line.startswith(b'data: '):
+                continue
+            
+            line = line[6:]
+            if line == b'[DONE]':
+                break
+            
+            chunk = orjson.loads(line)
+            if chunk.get('choices'):
+                content = chunk['choices'][0]['delta'].get('content')
+                if content:
+                    yield content
+
+    def _get_cached_rows(self):
+        """
+        Return rows cached for this request, or None if there are none fresh enough
+        """
+        cache_key = self._cache_key()
+        
+        if self.cache_ttl <= 0 or cache_key not in _RESPONSE_CACHE:
+            return None
+        
+        stored_at, data = _RESPONSE_CACHE[cache_key]
+        if time.monotonic() - stored_at >= self.cache_ttl:
+            del _RESPONSE_CACHE[cache_key]
+            return None
+        
+        _RESPONSE_CACHE.move_to_end(cache_key)
+        log_to_postgres(f'Using {len(data)} cached rows for OpenAI request', DEBUG)
+        return data
+
+    def _cache_rows(self, data):
+        """
+        Remember the rows returned for this request for cache_ttl seconds
+        """
+        if self.cache_ttl <= 0:
+            return
+        
+        cache_key = self._cache_key()
+        _RESPONSE_CACHE[cache_key] = (time.monotonic(), data)
+        _RESPONSE_CACHE.move_to_end(cache_key)
+        if len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+
+    def _cache_key(self):
+        """
+        Build the response cache key identifying this request
+        """
+        return (self.model, self.prompt, self.max_rows, self.max_tokens, round(self.temperature, 3), self._schema_instruction)
+
+    def _build_payload(self, row_count, shard=0, shards=1):
+        """
+        Build the chat completion payload asking for row_count rows
+
+        Each shard of a split request is told its position so the concurrent
+        completions produce different rows rather than near-duplicates.
+        """
+        full_prompt = f"{self._full_prompt_prefix}\nReturn {row_count} rows maximum. Do not include any text before or after the JSON object.\n"
+        if shards > 1:
+            full_prompt += f"This is part {shard + 1} of {shards} of a larger request; make these rows different from the rows generated for the other parts.\n"
+        
+        if self.response_format == 'json_schema':
+            response_format = {
+                'type': 'json_schema',
+                'json_schema': {
+                    'name': 'rows',
+                    'strict': True,
+                    'schema': {
+                        'type': 'object',
+                        'properties': {'rows': {'type': 'array', 'items': self._schema_dict}},
+                        'required': ['rows'],
+                        'additionalProperties': False
+                    }
+                }
+            }
+        else:
+            response_format = {'type': 'json_object'}
         
-        payload = {
+        return {
             'model': self.model,
             'messages': [
                 {
                     'role': 'system',
-                    'content': 'You are a data generator. Always return valid JSON arrays matching the requested schema exactly. Never include explanatory text.'
+                    'content': 'You are a data generator. Always return a JSON object whose "rows" array matches the requested schema exactly. Never include explanatory text.'
                 },
                 {
                     'role': 'user',
@@ -129,116 +619,207 @@ Return {self.max_rows} rows maximum. Do not include any text before or after the
                 }
             ],
             'max_tokens': self.max_tokens,
-            'temperature': self.temperature
+            'temperature': self.temperature,
+            'response_format': response_format
         }
+
+    def _request_rows(self, payload):
+        """
+        Send one chat completion request and return the parsed list of rows
+
+        This may run on a worker thread, so it must not call log_to_postgres;
+        failures are raised and reported by the caller.
+        """
+        response = self._send('POST', OPENAI_CHAT_URL, json=payload)
         
-        try:
-            log_to_postgres(f'Making OpenAI API request with model: {self.model}', DEBUG)
+        return self._parse_completion(orjson.loads(response.content))
+
+    def _request_batch_rows(self, payloads):
+        """
+        Run the payloads as an OpenAI Batch API job and return one row list per payload
+
+        The batch id is kept for the rest of the transaction so that repeated
+        scans reuse the submitted job instead of creating a new one.
+        """
+        if self._batch_id is None:
+            lines = [
+                orjson.dumps({
+                    'custom_id': f'shard-{i}',
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': payload
+                })
+                for i, payload in enumerate(payloads)
+            ]
             
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=60
+            response = self._send(
+                'POST',
+                OPENAI_FILES_URL,
+                retry=False,
+                data={'purpose': 'batch'},
+                files={'file': ('openai_fdw_batch.jsonl', b'\n'.join(lines))}
             )
             
-            response.raise_for_status()
+            response = self._send(
+                'POST',
+                OPENAI_BATCHES_URL,
+                retry=False,
+                json={
+                    'input_file_id': orjson.loads(response.content)['id'],
+                    'endpoint': '/v1/chat/completions',
+                    'completion_window': '24h'
+                }
+            )
             
-            result = response.json()
+            self._batch_id = orjson.loads(response.content)['id']
+        
+        delay = 1
+        while True:
+            response = self._send('GET', f'{OPENAI_BATCHES_URL}/{self._batch_id}')
+            batch = orjson.loads(response.content)
             
-            if 'choices' not in result or not result['choices']:
-                log_to_postgres('No choices in OpenAI response', ERROR)
-                return None
+            if batch['status'] == 'completed':
+                break
+            if batch['status'] in ['failed', 'expired', 'cancelling', 'cancelled']:
+                self._batch_id = None
+                raise ValueError(f"OpenAI batch {batch['id']} ended with status: {batch['status']}")
             
-            content = result['choices'][0]['message']['content'].strip()
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_INTERVAL)
+        
+        # Requests that failed are written to the error file, not the output
+        failed = (batch.get('request_counts') or {}).get('failed', 0)
+        if not batch.get('output_file_id'):
+            raise ValueError(f"OpenAI batch {batch['id']} completed without an output file ({failed} requests failed, error file: {batch.get('error_file_id')})")
+        if failed or batch.get('error_file_id'):
+            log_to_postgres(f"{failed or 'Some'} of {len(payloads)} requests in OpenAI batch {batch['id']} failed, returning rows from the rest (error file: {batch.get('error_file_id')})", WARNING)
+        
+        response = self._send('GET', f"{OPENAI_FILES_URL}/{batch['output_file_id']}/content")
+        
+        results = []
+        for line in response.content.splitlines():
+            if not line.strip():
+                continue
             
+            item = orjson.loads(line)
+            if not item.get('response') or item['response']['status_code'] != 200:
+                raise ValueError(f"OpenAI batch request {item['custom_id']} failed: {item.get('error')}")
+            
+            results.append(self._parse_completion(item['response']['body']))
+        
+        return results
+
+    def _send(self, method, url, retry=True, **kwargs):
+        """
+        Send an API request, retrying rate limits, server errors and connection
+        failures with exponential backoff for up to max_attempts attempts
+
+        Requests that are not safe to repeat, such as creating a batch job that
+        the server may already have accepted, pass retry=False and are sent
+        once. Like _request_rows this may run on a worker thread and must not log.
+        """
+        attempts = self.max_attempts if retry else 1
+        delay = 1
+        for attempt in range(1, attempts + 1):
+            wait = delay
             try:
-                # Remove any potential markdown code blocks
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                content = content.strip()
-                
-                data = json.loads(content)
-                
-                if not isinstance(data, list):
-                    log_to_postgres(f'Expected JSON array, got: {type(data)}', ERROR)
-                    return None
-                
-                log_to_postgres(f'Successfully parsed {len(data)} rows from OpenAI response', INFO)
-                return data
-                
-            except json.JSONDecodeError as e:
-                log_to_postgres(f'Failed to parse JSON response: {e}\nContent: {content}', ERROR)
-                return None
-                
-        except requests.exceptions.RequestException as e:
-            log_to_postgres(f'HTTP request failed: {str(e)}', ERROR)
+                response = _SESSION.request(method, url, headers=self._headers, timeout=60, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                    response.raise_for_status()
+                    return response
+                retry_after = self._retry_after(response)
+                if retry_after is not None:
+                    wait = retry_after
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == attempts:
+                    raise
+            
+            time.sleep(wait)
+            delay = min(delay * 2, RETRY_MAX_INTERVAL)
+
+    def _retry_after(self, response):
+        """
+        Return the delay in seconds requested by a Retry-After header, clamped
+        to RETRY_MAX_INTERVAL, or None if the response has none in that form
+        """
+        try:
+            retry_after = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+        
+        # Never block the backend for longer than our own backoff would
+        return min(max(0.0, retry_after), RETRY_MAX_INTERVAL)
+
+    def _parse_completion(self, result):
+        """
+        Extract the JSON array of rows from a chat completion response body
+        """
+        if 'choices' not in result or not result['choices']:
+            raise ValueError('No choices in OpenAI response')
+        
+        content = result['choices'][0]['message']['content']
+        
+        try:
+            data = orjson.loads(content)
+        except orjson.JSONDecodeError as e:
+            raise ValueError(f'Failed to parse JSON response: {e}\nContent: {content}')
+        
+        if not isinstance(data, dict) or not isinstance(data.get('rows'), list):
+            raise ValueError(f'Expected JSON object with a "rows" array, got: {content[:200]}')
+        
+        return data['rows']
+
+    def _count_prompt_tokens(self):
+        """
+        Count the tokens of the prompt sent with each request, or return None
+        if tiktoken is not available
+        """
+        if tiktoken is None:
             return None
+        
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                # Model unknown to tiktoken, use the current chat model encoding
+                encoding = tiktoken.get_encoding('cl100k_base')
         except Exception as e:
-            log_to_postgres(f'Unexpected error in OpenAI request: {str(e)}', ERROR)
+            # Encodings are downloaded on first use, which may not be possible
+            log_to_postgres(f'Could not load tiktoken encoding: {str(e)}', DEBUG)
             return None
+        
+        return len(encoding.encode(self._full_prompt_prefix))
 
     def _validate_row_schema(self, row_data):
         """
         Validate that a row from the API response matches the expected schema
         """
-        if not isinstance(row_data, dict):
-            return False
+        if validate_row is not None:
+            return validate_row(row_data, self._column_spec)
         
-        for column_name, column_def in self.columns.items():
-            if column_name in row_data:
-                value = row_data[column_name]
-                pg_type = column_def.type_name.lower()
-                
-                # Type validation
-                if pg_type in ['integer', 'int4', 'int8', 'bigint', 'smallint']:
-                    if not isinstance(value, int):
-                        return False
-                elif pg_type in ['real', 'float4', 'float8', 'double precision', 'numeric', 'decimal']:
-                    if not isinstance(value, (int, float)):
-                        return False
-                elif pg_type in ['boolean', 'bool']:
-                    if not isinstance(value, bool):
-                        return False
-                elif pg_type in ['text', 'varchar', 'char', 'date', 'timestamp', 'timestamptz']:
-                    if not isinstance(value, str):
-                        return False
-        
-        return True
+        return self._validate(row_data)
 
     def _convert_row_to_postgres_format(self, row_data):
         """
         Convert a row from the API response to PostgreSQL format
         """
-        converted_row = {}
+        if convert_row is not None:
+            return convert_row(row_data, self._column_spec)
         
-        for column_name in self.column_names:
-            if column_name in row_data:
-                value = row_data[column_name]
-                
-                # Handle null values
-                if value is None:
-                    converted_row[column_name] = None
-                else:
-                    # Convert based on PostgreSQL column type
-                    column_def = self.columns[column_name]
-                    pg_type = column_def.type_name.lower()
-                    
-                    if pg_type in ['integer', 'int4', 'int8', 'bigint', 'smallint']:
-                        converted_row[column_name] = int(value)
-                    elif pg_type in ['real', 'float4', 'float8', 'double precision', 'numeric', 'decimal']:
-                        converted_row[column_name] = float(value)
-                    elif pg_type in ['boolean', 'bool']:
-                        converted_row[column_name] = bool(value)
-                    else:
-                        converted_row[column_name] = str(value)
-            else:
-                # Column not in response, set to None
-                converted_row[column_name] = None
-        
-        return converted_row
+        return self._convert(row_data)
+
+    def commit(self):
+        """
+        Forget the batch job once the transaction that submitted it ends
+        """
+        self._batch_id = None
+
+    def rollback(self):
+        """
+        Forget the batch job once the transaction that submitted it ends
+        """
+        self._batch_id = None
 
     def can_sort(self, sortkeys):
         """
@@ -250,9 +831,15 @@ Return {self.max_rows} rows maximum. Do not include any text before or after the
         """
         Provide query execution plan information
         """
+        # Counted here rather than at init, since loading a tiktoken encoding
+        # may download it and should not hold up planning of every query
+        prompt_tokens = self._count_prompt_tokens()
+        
         return [
             f"OpenAI API call to model: {self.model}",
             f"Prompt: {self.prompt[:100]}..." if len(self.prompt) > 100 else f"Prompt: {self.prompt}",
             f"Expected columns: {', '.join(self.column_names)}",
-            f"Max rows: {self.max_rows}"
+            f"Max rows: {self.max_rows}",
+            f"Shards: {self.shard_count}",
+            f"Prompt tokens: {prompt_tokens}" if prompt_tokens is not None else "Prompt tokens: unknown"
         ]
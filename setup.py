@@ -1,14 +1,27 @@
-from setuptools import setup
+from setuptools import Extension, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # Cython is optional; without it only the pure Python wrapper is installed
+    ext_modules = []
+else:
+    ext_modules = cythonize([Extension("_fdw_fast", ["_fdw_fast.pyx"])])
 
 setup(
     name="pg-fdw-ai",
     version="1.0.0",
     description="PostgreSQL Foreign Data Wrapper for OpenAI API integration",
     py_modules=["openai_fdw"],
+    ext_modules=ext_modules,
     python_requires=">=3.7",
     install_requires=[
         "requests>=2.25.0",
+        "orjson>=3.6.0",
     ],
+    extras_require={
+        "tokens": ["tiktoken"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import multicorn  # noqa: F401
+except ImportError:
+    # Multicorn is only importable inside a PostgreSQL backend; provide the
+    # names the wrapper uses, recording log messages and raising on ERROR
+    # the way log_to_postgres does
+    class ForeignDataWrapper(object):
+        def __init__(self, options, columns):
+            pass
+
+    def log_to_postgres(message, level=20, hint=None):
+        utils.messages.append((level, message))
+        if level == utils.ERROR:
+            raise RuntimeError(message)
+
+    multicorn = types.ModuleType('multicorn')
+    multicorn.ForeignDataWrapper = ForeignDataWrapper
+    utils = types.ModuleType('multicorn.utils')
+    utils.log_to_postgres = log_to_postgres
+    utils.ERROR, utils.WARNING, utils.DEBUG = 40, 30, 10
+    utils.messages = []
+    multicorn.utils = utils
+    sys.modules['multicorn'] = multicorn
+    sys.modules['multicorn.utils'] = utils
+
+
+class Column(object):
+    def __init__(self, type_name):
+        self.type_name = type_name
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, body=None, content=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        if content is None:
+            content = json.dumps(body).encode('utf-8')
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code), response=self)
+
+    def iter_lines(self):
+        return iter(self.content.splitlines())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@pytest.fixture
+def logged():
+    """
+    Messages passed to the stub log_to_postgres during the test
+    """
+    utils = sys.modules['multicorn.utils']
+    if not hasattr(utils, 'messages'):
+        pytest.skip('log messages are only recorded with the stub multicorn')
+    del utils.messages[:]
+    return utils.messages
+
+
+@pytest.fixture
+def make_fdw():
+    """
+    Build a wrapper with test options over a small default table
+    """
+    import openai_fdw
+
+    def make(columns=None, **options):
+        options = dict({'api_key': 'sk-test', 'prompt': 'Generate rows'}, **options)
+        if columns is None:
+            columns = {'id': Column('integer'), 'name': Column('text')}
+        return openai_fdw.OpenAIForeignDataWrapper(options, columns)
+
+    return make
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Replace the shared session and sleeps: responses are served from
+    api.responses in order and every call is recorded in api.calls
+    """
+    import openai_fdw
+
+    class Api(object):
+        def __init__(self):
+            self.responses = []
+            self.calls = []
+            self.sleeps = []
+
+        def request(self, method, url, **kwargs):
+            self.calls.append((method, url, kwargs))
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response(method, url, kwargs) if callable(response) else response
+
+    fake = Api()
+    monkeypatch.setattr(openai_fdw._SESSION, 'request', fake.request)
+    monkeypatch.setattr(openai_fdw.time, 'sleep', fake.sleeps.append)
+    openai_fdw._RESPONSE_CACHE.clear()
+    return fake
@@ -0,0 +1,301 @@
+import pytest
+import requests
+
+import openai_fdw
+from conftest import FakeResponse
+
+
+def completion(rows):
+    return FakeResponse(body={'choices': [{'message': {'content': openai_fdw.orjson.dumps({'rows': rows}).decode()}}]})
+
+
+def streamed(text, size=5):
+    lines = [
+        b'data: ' + openai_fdw.orjson.dumps({'choices': [{'delta': {'content': text[i:i + size]}}]})
+        for i in range(0, len(text), size)
+    ]
+    return FakeResponse(content=b'\n\n'.join(lines + [b'data: [DONE]']))
+
+
+def test_send_retries_transient_failures(make_fdw, api):
+    fdw = make_fdw()
+    api.responses = [FakeResponse(500), requests.exceptions.ConnectionError('reset'), completion([{'id': 1}])]
+    assert fdw._request_rows({}) == [{'id': 1}]
+    assert len(api.calls) == 3
+    assert api.sleeps == [1, 2]
+
+
+def test_send_gives_up_after_max_attempts(make_fdw, api):
+    fdw = make_fdw(max_attempts='2')
+    api.responses = [FakeResponse(503), FakeResponse(503)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        fdw._send('POST', openai_fdw.OPENAI_CHAT_URL, json={})
+    assert len(api.calls) == 2
+
+
+def test_send_does_not_retry_client_errors(make_fdw, api):
+    fdw = make_fdw()
+    api.responses = [FakeResponse(400)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        fdw._send('POST', openai_fdw.OPENAI_CHAT_URL, json={})
+    assert len(api.calls) == 1
+
+
+def test_send_without_retry_is_sent_once(make_fdw, api):
+    fdw = make_fdw()
+    api.responses = [requests.exceptions.Timeout('slow')]
+    with pytest.raises(requests.exceptions.Timeout):
+        fdw._send('POST', openai_fdw.OPENAI_BATCHES_URL, retry=False, json={})
+    assert len(api.calls) == 1
+    assert api.sleeps == []
+
+
+def test_send_honours_retry_after(make_fdw, api):
+    fdw = make_fdw()
+    api.responses = [FakeResponse(429, headers={'Retry-After': '3'}), FakeResponse(200, body={})]
+    fdw._send('GET', openai_fdw.OPENAI_BATCHES_URL)
+    assert api.sleeps == [3.0]
+
+
+@pytest.mark.parametrize('retry_after', ['100000', 'inf'])
+def test_send_clamps_oversized_retry_after(make_fdw, api, retry_after):
+    fdw = make_fdw()
+    api.responses = [FakeResponse(429, headers={'Retry-After': retry_after}), FakeResponse(200, body={})]
+    fdw._send('GET', openai_fdw.OPENAI_BATCHES_URL)
+    assert api.sleeps == [openai_fdw.RETRY_MAX_INTERVAL]
+
+
+def test_send_ignores_http_date_retry_after(make_fdw, api):
+    fdw = make_fdw()
+    api.responses = [FakeResponse(429, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), FakeResponse(200, body={})]
+    fdw._send('GET', openai_fdw.OPENAI_BATCHES_URL)
+    assert api.sleeps == [1]
+
+
+@pytest.mark.parametrize('strict', ['false', 'true'])
+def test_stream_rejects_scalar_rows(make_fdw, api, logged, strict):
+    fdw = make_fdw(stream='true', strict_validation=strict)
+    api.responses = [streamed('{"rows": [{"id": 1, "name": "a"}, 2, "b", {"id": 3, "name": "c"}]}')]
+    assert list(fdw.execute([], ['id', 'name'])) == [{'id': 1, 'name': 'a'}, {'id': 3, 'name': 'c'}]
+    skipped = [message for level, message in logged if message.startswith('Skipping invalid row')]
+    assert len(skipped) == 2
+
+
+def echo_rows(method, url, kwargs):
+    # Answer a shard with as many rows as its prompt asks for
+    prompt = kwargs['json']['messages'][1]['content']
+    row_count = int(prompt.rsplit('Return ', 1)[1].split()[0])
+    return completion([{'id': i, 'name': prompt} for i in range(row_count)])
+
+
+def test_shards_split_rows_evenly(make_fdw, api):
+    fdw = make_fdw(max_rows='10', shard_count='4', cache_ttl='0')
+    api.responses = [echo_rows] * 4
+    rows = fdw._make_openai_request()
+    assert len(rows) == 10
+    prompts = [kwargs['json']['messages'][1]['content'] for method, url, kwargs in api.calls]
+    assert sorted(prompt.rsplit('Return ', 1)[1].split()[0] for prompt in prompts) == ['2', '2', '3', '3']
+    assert sorted(prompt.split('This is part ')[1][:6] for prompt in prompts) == ['1 of 4', '2 of 4', '3 of 4', '4 of 4']
+
+
+def test_single_shard_payload(make_fdw, api):
+    fdw = make_fdw(max_rows='10', cache_ttl='0')
+    api.responses = [echo_rows]
+    assert len(fdw._make_openai_request()) == 10
+    assert len(api.calls) == 1
+    payload = api.calls[0][2]['json']
+    assert 'Return 10 rows maximum' in payload['messages'][1]['content']
+    assert 'This is part' not in payload['messages'][1]['content']
+    assert payload['response_format'] == {'type': 'json_object'}
+
+
+def test_shard_count_above_max_rows_sends_one_row_per_shard(make_fdw, api):
+    fdw = make_fdw(max_rows='3', shard_count='8', cache_ttl='0')
+    api.responses = [echo_rows] * 3
+    assert len(fdw._make_openai_request()) == 3
+    assert len(api.calls) == 3
+
+
+def test_json_schema_payload(make_fdw, api):
+    fdw = make_fdw(max_rows='2', response_format='json_schema', cache_ttl='0')
+    api.responses = [echo_rows]
+    fdw._make_openai_request()
+    response_format = api.calls[0][2]['json']['response_format']
+    assert response_format['type'] == 'json_schema'
+    row_schema = response_format['json_schema']['schema']['properties']['rows']['items']
+    assert row_schema['properties'] == {'id': {'type': ['integer', 'null']}, 'name': {'type': ['string', 'null']}}
+    assert row_schema['required'] == ['id', 'name']
+
+
+def batch_output(*rows_per_shard):
+    lines = [
+        openai_fdw.orjson.dumps({
+            'custom_id': f'shard-{i}',
+            'response': {
+                'status_code': 200,
+                'body': {'choices': [{'message': {'content': openai_fdw.orjson.dumps({'rows': rows}).decode()}}]},
+            },
+        })
+        for i, rows in enumerate(rows_per_shard)
+    ]
+    return FakeResponse(content=b'\n'.join(lines) + b'\n')
+
+
+def test_batch_polls_until_completed(make_fdw, api, logged):
+    fdw = make_fdw(max_rows='4', shard_count='2', use_batch_api='true')
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'in_progress'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'in_progress'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out', 'request_counts': {'failed': 0}}),
+        batch_output([{'id': 1}, {'id': 2}], [{'id': 3}, {'id': 4}]),
+    ]
+    assert fdw._make_openai_request() == [{'id': 1}, {'id': 2}, {'id': 3}, {'id': 4}]
+    assert [(method, url) for method, url, kwargs in api.calls] == [
+        ('POST', openai_fdw.OPENAI_FILES_URL),
+        ('POST', openai_fdw.OPENAI_BATCHES_URL),
+        ('GET', f'{openai_fdw.OPENAI_BATCHES_URL}/batch-1'),
+        ('GET', f'{openai_fdw.OPENAI_BATCHES_URL}/batch-1'),
+        ('GET', f'{openai_fdw.OPENAI_BATCHES_URL}/batch-1'),
+        ('GET', f'{openai_fdw.OPENAI_FILES_URL}/file-out/content'),
+    ]
+    assert api.calls[1][2]['json']['input_file_id'] == 'file-in'
+    uploaded = api.calls[0][2]['files']['file'][1].splitlines()
+    assert [openai_fdw.orjson.loads(line)['custom_id'] for line in uploaded] == ['shard-0', 'shard-1']
+    assert api.sleeps == [1, 2]
+    assert not [message for level, message in logged if level == openai_fdw.WARNING]
+
+
+def test_batch_id_reused_within_transaction(make_fdw, api):
+    fdw = make_fdw(max_rows='2', use_batch_api='true', cache_ttl='0')
+    completed = FakeResponse(body={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out'})
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        completed,
+        batch_output([{'id': 1}]),
+        completed,
+        batch_output([{'id': 1}]),
+    ]
+    fdw._make_openai_request()
+    fdw._make_openai_request()
+    assert [method for method, url, kwargs in api.calls].count('POST') == 2
+    
+    fdw.commit()
+    assert fdw._batch_id is None
+
+
+@pytest.mark.parametrize('status', ['failed', 'expired', 'cancelled'])
+def test_batch_terminal_status_raises(make_fdw, api, status):
+    fdw = make_fdw(max_rows='2', use_batch_api='true')
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        FakeResponse(body={'id': 'batch-1', 'status': status}),
+    ]
+    with pytest.raises(ValueError, match=status):
+        fdw._request_batch_rows([{}])
+    assert fdw._batch_id is None
+
+
+def test_batch_without_output_file_raises(make_fdw, api):
+    fdw = make_fdw(max_rows='2', use_batch_api='true')
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'completed', 'output_file_id': None,
+                           'error_file_id': 'file-err', 'request_counts': {'failed': 1}}),
+    ]
+    with pytest.raises(ValueError, match='file-err'):
+        fdw._request_batch_rows([{}])
+
+
+def test_batch_partial_failure_warns(make_fdw, api, logged):
+    fdw = make_fdw(max_rows='4', shard_count='2', use_batch_api='true')
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out',
+                           'error_file_id': 'file-err', 'request_counts': {'failed': 1}}),
+        batch_output([{'id': 1}, {'id': 2}]),
+    ]
+    assert fdw._request_batch_rows([{}, {}]) == [[{'id': 1}, {'id': 2}]]
+    warnings = [message for level, message in logged if level == openai_fdw.WARNING]
+    assert len(warnings) == 1
+    assert '1 of 2 requests' in warnings[0] and 'file-err' in warnings[0]
+
+
+def test_batch_failed_output_line_raises(make_fdw, api):
+    fdw = make_fdw(max_rows='2', use_batch_api='true')
+    api.responses = [
+        FakeResponse(body={'id': 'file-in'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'validating'}),
+        FakeResponse(body={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out'}),
+        FakeResponse(content=b'{"custom_id": "shard-0", "response": {"status_code": 500, "body": {}}, "error": null}\n'),
+    ]
+    with pytest.raises(ValueError, match='shard-0'):
+        fdw._request_batch_rows([{}])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(openai_fdw.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_cache_ttl_defaults_to_deterministic_requests_only(make_fdw):
+    assert make_fdw(temperature='0').cache_ttl == 300
+    assert make_fdw().cache_ttl == 0
+    assert make_fdw(cache_ttl='60').cache_ttl == 60
+
+
+def test_cache_hit_within_ttl(make_fdw, api, clock):
+    api.responses = [completion([{'id': 1}])]
+    assert make_fdw(max_rows='10', cache_ttl='60')._make_openai_request() == [{'id': 1}]
+    clock[0] += 59
+    assert make_fdw(max_rows='10', cache_ttl='60')._make_openai_request() == [{'id': 1}]
+    assert len(api.calls) == 1
+
+
+def test_cache_expires_after_ttl(make_fdw, api, clock):
+    api.responses = [completion([{'id': 1}]), completion([{'id': 2}])]
+    fdw = make_fdw(max_rows='10', cache_ttl='60')
+    assert fdw._make_openai_request() == [{'id': 1}]
+    clock[0] += 60
+    assert fdw._make_openai_request() == [{'id': 2}]
+    assert len(api.calls) == 2
+
+
+def test_cache_keyed_by_request(make_fdw, api):
+    api.responses = [completion([{'id': 1}]), completion([{'id': 2}])]
+    assert make_fdw(max_rows='10', cache_ttl='60')._make_openai_request() == [{'id': 1}]
+    assert make_fdw(max_rows='10', cache_ttl='60', prompt='Other rows')._make_openai_request() == [{'id': 2}]
+    assert len(api.calls) == 2
+
+
+def test_cache_disabled(make_fdw, api):
+    api.responses = [completion([{'id': 1}]), completion([{'id': 1}])]
+    fdw = make_fdw(max_rows='10', cache_ttl='0')
+    fdw._make_openai_request()
+    fdw._make_openai_request()
+    assert len(api.calls) == 2
+    assert not openai_fdw._RESPONSE_CACHE
+
+
+def test_cache_evicts_least_recently_used(make_fdw, api, monkeypatch):
+    monkeypatch.setattr(openai_fdw, 'RESPONSE_CACHE_SIZE', 2)
+    first, second, third = (make_fdw(max_rows='10', cache_ttl='60', prompt=f'Prompt {i}') for i in range(3))
+    api.responses = [completion([{'id': i}]) for i in range(4)]
+    first._make_openai_request()
+    second._make_openai_request()
+    # Using the first entry again leaves the second as least recently used
+    first._make_openai_request()
+    third._make_openai_request()
+    assert len(openai_fdw._RESPONSE_CACHE) == 2
+    assert len(api.calls) == 3
+    
+    assert first._make_openai_request() == [{'id': 0}]
+    assert second._make_openai_request() == [{'id': 3}]
+    assert len(api.calls) == 4
@@ -0,0 +1,187 @@
+import json
+import random
+
+import pytest
+from multicorn.utils import WARNING
+
+from conftest import Column
+from openai_fdw import (
+    HTTP_POOL_SIZE, KIND_BOOLEAN, KIND_FLOAT, KIND_INTEGER, KIND_OTHER, KIND_TEXT,
+    _compile_row_functions, _iter_json_array,
+)
+
+
+ROWS = [
+    {'id': 1, 'name': 'plain'},
+    {'id': 2, 'name': 'quote " and backslash \\ inside'},
+    {'id': 3, 'name': 'brackets ]}[{ inside a string'},
+    {'id': 4, 'name': 'escaped \\" then ] and }'},
+    {'id': 5, 'tags': ['a', ['b', {'c': '}'}]], 'meta': {'k': [1, 2]}},
+    {'id': 6, 'name': 'unicode é中'},
+]
+
+SPEC = (
+    ('i', KIND_INTEGER),
+    ('f', KIND_FLOAT),
+    ('b', KIND_BOOLEAN),
+    ('t', KIND_TEXT),
+    ('o', KIND_OTHER),
+)
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def buckets(spec):
+    column_buckets = {kind: [] for kind in (KIND_INTEGER, KIND_FLOAT, KIND_BOOLEAN, KIND_TEXT, KIND_OTHER)}
+    for column_name, kind in spec:
+        column_buckets[kind].append(column_name)
+    return column_buckets
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 1000])
+@pytest.mark.parametrize('text', [
+    json.dumps(ROWS),
+    json.dumps({'rows': ROWS}),
+    '```json\n' + json.dumps({'rows': ROWS}, indent=2) + '\n```',
+])
+def test_iter_json_array_yields_every_row(text, size):
+    assert list(_iter_json_array(chunked(text, size))) == ROWS
+
+
+def test_iter_json_array_random_split_points():
+    text = json.dumps({'rows': ROWS})
+    rng = random.Random(0)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(text)), rng.randint(0, 30)))
+        chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        assert list(_iter_json_array(chunks)) == ROWS
+
+
+def test_iter_json_array_empty_array():
+    assert list(_iter_json_array(chunked('{"rows": []}', 2))) == []
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_iter_json_array_yields_scalar_elements(size):
+    text = '{"rows": [1, "a [string]", {"id": 1}, true, null, -2.5e3,"b\\"",{"id": 2}, 42]}'
+    assert list(_iter_json_array(chunked(text, size))) == [
+        1, 'a [string]', {'id': 1}, True, None, -2500.0, 'b"', {'id': 2}, 42,
+    ]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_iter_json_array_truncated_mid_element(size):
+    text = json.dumps({'rows': ROWS})
+    cut = text.index('{"id": 3')
+    received = []
+    with pytest.raises(ValueError):
+        for row in _iter_json_array(chunked(text[:cut + 12], size)):
+            received.append(row)
+    assert received == ROWS[:2]
+
+
+def test_iter_json_array_without_array():
+    with pytest.raises(ValueError):
+        list(_iter_json_array(['no array here']))
+
+
+def test_generated_validate():
+    validate, _ = _compile_row_functions(buckets(SPEC))
+    assert validate({'i': 1, 'f': 1.5, 'b': True, 't': 'x', 'o': [1]})
+    assert validate({'f': 2})
+    assert validate({'i': None, 't': None})
+    assert validate({})
+    assert not validate([{'i': 1}])
+    assert not validate({'i': True})
+    assert not validate({'i': 1.0})
+    assert not validate({'f': '1.5'})
+    assert not validate({'b': 'false'})
+    assert not validate({'t': 1})
+
+
+def test_generated_convert():
+    _, convert = _compile_row_functions(buckets(SPEC))
+    assert convert({'i': 3.0, 'f': 2, 'b': False, 't': 'x', 'o': 5}) == {
+        'i': 3, 'f': 2.0, 'b': False, 't': 'x', 'o': '5'
+    }
+    assert convert({}) == {'i': None, 'f': None, 'b': None, 't': None, 'o': None}
+
+
+@pytest.mark.parametrize('row, error', [
+    ({'i': 3.9}, ValueError),
+    ({'i': 'abc'}, ValueError),
+    ({'i': True}, TypeError),
+    ({'f': False}, TypeError),
+    ({'t': True}, TypeError),
+    ({'o': False}, TypeError),
+    ({'b': 'false'}, TypeError),
+    ({'b': 1}, TypeError),
+    ({'t': {'a': 1}}, TypeError),
+    ({'o': [1]}, TypeError),
+])
+def test_generated_convert_rejects_misrepresented_values(row, error):
+    _, convert = _compile_row_functions(buckets(SPEC))
+    with pytest.raises(error):
+        convert(row)
+
+
+def test_generated_functions_quote_column_names():
+    spec = (("it's \"odd\"\n", KIND_INTEGER), ('x)]}', KIND_TEXT))
+    validate, convert = _compile_row_functions(buckets(spec))
+    row = {"it's \"odd\"\n": 1, 'x)]}': 'y'}
+    assert validate(row)
+    assert convert(row) == row
+
+
+def test_generated_functions_match_extension():
+    fast = pytest.importorskip('_fdw_fast')
+    validate, convert = _compile_row_functions(buckets(SPEC))
+    values = [None, 0, 1, 2.5, 3.0, True, False, 'x', '7', [1], {'a': 1}]
+    rng = random.Random(0)
+    
+    for _ in range(2000):
+        row = {name: rng.choice(values) for name, _ in SPEC if rng.random() < 0.8}
+        assert validate(row) == fast.validate_row(row, SPEC)
+        
+        outcomes = []
+        for fn in (convert, lambda r: fast.convert_row(r, SPEC)):
+            try:
+                outcomes.append(fn(row))
+            except (TypeError, ValueError):
+                outcomes.append('rejected')
+        assert outcomes[0] == outcomes[1]
+
+
+def test_auto_shard_estimate(make_fdw, logged):
+    # 2 columns * 100 rows * 25 tokens = 5000 tokens over a 1800 token budget
+    assert make_fdw().shard_count == 3
+    assert make_fdw(shard_count='5').shard_count == 5
+    assert not [message for level, message in logged if level == WARNING]
+
+
+def test_auto_shard_estimate_capped_at_one_row_per_shard(make_fdw, logged):
+    columns = {f'c{i}': Column('text') for i in range(100)}
+    fdw = make_fdw(columns, max_rows='5')
+    assert fdw.shard_count == 5
+    assert [message for level, message in logged if level == WARNING] == [
+        'Estimated 2500 output tokens per row exceed max_tokens, responses may be cut off',
+    ]
+
+
+def test_shard_count_capped_at_max_rows(make_fdw):
+    assert make_fdw(shard_count='8', max_rows='3').shard_count == 3
+
+
+def test_auto_shard_estimate_skipped_when_streaming(make_fdw, logged):
+    fdw = make_fdw(stream='true')
+    assert fdw.shard_count == 1
+    assert [message for level, message in logged if level == WARNING] == [
+        'Estimated 5000 output tokens exceed max_tokens, streamed output may be cut off',
+    ]
+
+
+def test_max_concurrency_capped_at_pool_size(make_fdw):
+    assert make_fdw(max_concurrency='4').max_concurrency == 4
+    assert make_fdw(max_concurrency='64').max_concurrency == HTTP_POOL_SIZE